@@ -41,6 +41,7 @@ export default {
       headers: {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0.0.0 Safari/537.36",
         "Referer": "http://quote.eastmoney.com/",
+        "Accept-Encoding": "gzip, deflate",
         "Connection": "keep-alive"
       }
     });
@@ -1,5 +1,6 @@
 # scripts/download_fundflow.py
 import requests
+import orjson
 import pandas as pd
 import os
 import json
@@ -26,7 +27,7 @@ def get_sina_flow(code):
     
     try:
         r = requests.get(url, headers=HEADERS, timeout=10)
-        data = r.json()
+        data = orjson.loads(r.content)
         if not data: return pd.DataFrame()
         
         df = pd.DataFrame(data)
@@ -39,6 +40,8 @@ def get_sina_flow(code):
             'r3_net': 'medium_small_net_flow'
         }
         df = df.rename(columns=rename_map)
+        # 日期存为 date32 (parquet 原生日期类型)
+        df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d', errors='coerce').dt.date
         
         # 转数值
         cols = ['net_flow_amount', 'main_net_flow', 'super_large_net_flow', 'large_net_flow', 'medium_small_net_flow']
@@ -47,15 +47,16 @@ def get_kdata_final(code):
     # -------------------------------------------------------
     # 3. 数据处理与合并
     # -------------------------------------------------------
-    df_k['date'] = pd.to_datetime(df_k['date'])
+    df_k['date'] = pd.to_datetime(df_k['date'], format='%Y-%m-%d')
     
     if data_fac:
         df_fac = pd.DataFrame(data_fac, columns=rs_fac.fields)
         df_fac.rename(columns={'dividOperateDate': 'date'}, inplace=True)
-        df_fac['date'] = pd.to_datetime(df_fac['date'])
+        df_fac['date'] = pd.to_datetime(df_fac['date'], format='%Y-%m-%d')
         
-        # Merge: 将因子并入 K 线
-        df_k = pd.merge(df_k, df_fac[['date', 'adjustFactor']], on='date', how='left')
+        # 按日期对齐：将因子并入 K 线 (同一日期多条时取最后一条)
+        fac = df_fac.drop_duplicates('date', keep='last').set_index('date')['adjustFactor']
+        df_k['adjustFactor'] = fac.reindex(df_k['date']).to_numpy()
         
         # 向下填充 (Forward Fill)
         df_k['adjustFactor'] = df_k['adjustFactor'].ffill()
@@ -66,7 +67,8 @@ def get_kdata_final(code):
     # -------------------------------------------------------
     # 4. 数值转换
     # -------------------------------------------------------
-    df_k['date'] = df_k['date'].dt.strftime('%Y-%m-%d')
+    # 日期存为 date32 (parquet 原生日期类型)，不再格式化成字符串
+    df_k['date'] = df_k['date'].dt.date
     
     numeric_cols = [
         'open', 'high', 'low', 'close', 
@@ -74,7 +76,11 @@ def get_kdata_final(code):
         'peTTM', 'pbMRQ', 'adjustFactor'
     ]
     
-    df_k[numeric_cols] = df_k[numeric_cols].apply(pd.to_numeric, errors='coerce')
+    # baostock 缺失值是空串，替换后一次性 astype；遇到意外的脏值再退回逐列 to_numeric
+    try:
+        df_k[numeric_cols] = df_k[numeric_cols].replace({'': np.nan, '-': np.nan}).astype('float64')
+    except (ValueError, TypeError):
+        df_k[numeric_cols] = df_k[numeric_cols].apply(pd.to_numeric, errors='coerce')
     
     # -------------------------------------------------------
     # 5. 计算流通市值 (Float Market Cap)
@@ -1,12 +1,20 @@
 # scripts/download_sector.py
 import requests
+import orjson
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import duckdb
 import time
 import random
 import os
+import io
 import sys
+import datetime
+from urllib.parse import urlencode
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 OUTPUT_DIR = "final_output/engine"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -14,150 +22,192 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 # 尝试获取 Cloudflare Worker 环境变量
 CF_WORKER_URL = os.getenv("CF_WORKER_URL")
 
+# 板块下载并发数 (Worker 在边缘节点，能扛更高并发；直连东财收着点)，可用 SECTOR_WORKERS 覆盖
+DOWNLOAD_WORKERS = int(os.getenv("SECTOR_WORKERS", 32 if CF_WORKER_URL else 8))
+
+# 板块列表变化很少，24 小时内的本地快照直接复用
+LIST_FILE = f"{OUTPUT_DIR}/sector_list.parquet"
+LIST_CACHE_TTL = 24 * 3600
+
+# secid 格式缓存：记住每个板块能用的 secid 写法 (带/不带 BK)，
+# 拉不到数据的板块也记下来，TTL 内不再重复请求
+SECID_CACHE_FILE = f"{OUTPUT_DIR}/secid_fmt.json"
+DEAD_CODE_TTL = 7 * 24 * 3600
+secid_fmt = {}
+dead_codes = {}
+
+# 板块宽表 (已有数据时按板块增量补齐)
+OUTPUT_FILE = f"{OUTPUT_DIR}/sector_full.parquet"
+# zstd 3 级：压缩率与 CPU 开销的平衡点
+ZSTD_LEVEL = 3
+# 按 code 排序后分小 row group，配合列统计信息，下游按板块过滤时能跳过整块
+ROW_GROUP_SIZE = 128_000
+FULL_BEG = "19900101"
+
+# 宽表列顺序 (无资金流的板块补 NaN)
+SECTOR_COLUMNS = [
+    'date', 'open', 'close', 'high', 'low', 'volume', 'amount', 'turnover', 'code',
+    'net_flow_amount', 'small_net_flow', 'medium_net_flow', 'large_net_flow', 'super_large_net_flow', 'main_net_flow'
+]
+FLOW_COLUMNS = ['net_flow_amount', 'small_net_flow', 'medium_net_flow', 'large_net_flow', 'super_large_net_flow', 'main_net_flow']
+
+# 固定的 Arrow schema (数值 float32，日期 date32)，写入时直接套用，不再逐个板块推断
+def _schema(columns):
+    types = {'date': pa.date32(), 'code': pa.string()}
+    return pa.schema([(c, types.get(c, pa.float32())) for c in columns])
+
+SECTOR_SCHEMA = _schema(SECTOR_COLUMNS)
+FLOW_SCHEMA = _schema(['date', 'code'] + FLOW_COLUMNS)
+# K 线暂存文件多一列 is_new：历史行 False、本次下载 True，合并时同一 (code, date) 以下载的为准
+KLINE_STAGE_SCHEMA = SECTOR_SCHEMA.append(pa.field('is_new', pa.bool_()))
+
+# 收盘后数据落定的时间 (北京时间)；早于此时写入的当天 K 线可能是盘中未完成的
+SETTLE_TIME = datetime.time(15, 30)
+
+# K 线 / 资金流接口中固定不变的查询参数，预先编码一次
+KLINE_URL = "http://push2his.eastmoney.com/api/qt/stock/kline/get"
+KLINE_QS = urlencode({
+    "fields1": "f1,f2,f3,f4,f5,f6",
+    "fields2": "f51,f52,f53,f54,f55,f56,f57,f58", # 日期,开,收,高,低,量,额,换手
+    "klt": "101", "fqt": "1", "end": "20500101", "lmt": "1000000"
+})
+FLOW_URL = "http://push2his.eastmoney.com/api/qt/stock/fflow/daykline/get"
+# 字段映射：
+# f51:日期, f52:主力净流入, f53:小单, f54:中单, f55:大单, f56:超大单
+FLOW_QS = urlencode({
+    "fields1": "f1,f2,f3,f7",
+    "fields2": "f51,f52,f53,f54,f55,f56",
+    "klt": "101", "lmt": "0" # 0代表全量
+})
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0.0.0 Safari/537.36",
     "Referer": "http://quote.eastmoney.com/",
-    "Connection": "close"
+    # K 线报文几乎全是数字和逗号，压缩后体积小得多 (br 需额外装 brotli，不请求)
+    "Accept-Encoding": "gzip, deflate"
 }
 
+# 重试策略 (Decorrelated Jitter): 每次等待在 [BASE, 上次等待*3] 间随机，上限 CAP
+RETRY_TIMES = 5
+RETRY_BASE = 0.25
+RETRY_CAP = 15
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
 def create_session():
-    """创建一个高可用的 Session"""
+    """创建 Session (keep-alive 连接池按并发数放大；重试由 fetch_json 负责，适配器层不再重试)"""
     session = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, status_forcelist=[500, 502, 503, 504, 104])
-    session.mount('http://', HTTPAdapter(max_retries=retries))
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_WORKERS, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
     session.headers.update(HEADERS)
     return session
 
 sess = create_session()
 
+def fetch_json(url, params=None, timeout=10):
+    """带抖动退避重试的 GET，返回解析后的 JSON (返回体截断/为空等解析失败也重试)"""
+    delay = RETRY_BASE
+    for attempt in range(1, RETRY_TIMES + 1):
+        try:
+            resp = sess.get(url, params=params, timeout=timeout)
+            if resp.status_code in RETRY_STATUS:
+                raise requests.HTTPError(f"HTTP {resp.status_code}", response=resp)
+            return orjson.loads(resp.content)
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError, orjson.JSONDecodeError):
+            if attempt == RETRY_TIMES: raise
+            delay = min(RETRY_CAP, random.uniform(RETRY_BASE, delay * 3))
+            time.sleep(delay)
+
 def get_sector_list_raw(name, fs):
-    """获取板块列表"""
-    sectors = []
-    page = 1
-    page_size = 100
+    """获取板块列表 (每类板块不过几百个，pz=5000 一次取完，不再分页)"""
     base_url = "http://17.push2.eastmoney.com/api/qt/clist/get"
-    
-    print(f"正在获取 {name} 列表...", end="", flush=True)
-    
-    while True:
-        success = False
-        res_json = None
-        for retry in range(3):
-            params = {
-                "pn": page, "pz": page_size, "po": 1, "np": 1, 
-                "ut": "bd1d9ddb04089700cf9c27f6f7426281",
-                "fltt": 2, "invt": 2, "fid": "f3", "fs": fs,
-                "fields": "f12,f13,f14" 
-            }
-            try:
-                if CF_WORKER_URL:
-                    params["target_func"] = "list"
-                    resp = sess.get(CF_WORKER_URL, params=params, timeout=30)
-                else:
-                    resp = sess.get(base_url, params=params, timeout=10)
-                res_json = resp.json()
-                success = True
-                break
-            except:
-                time.sleep(1)
+    params = {
+        "pn": 1, "pz": 5000, "po": 1, "np": 1, 
+        "ut": "bd1d9ddb04089700cf9c27f6f7426281",
+        "fltt": 2, "invt": 2, "fid": "f3", "fs": fs,
+        "fields": "f12,f13,f14" 
+    }
+    try:
+        if CF_WORKER_URL:
+            params["target_func"] = "list"
+            res_json = fetch_json(CF_WORKER_URL, params=params, timeout=30)
+        else:
+            res_json = fetch_json(base_url, params=params, timeout=10)
+    except:
+        print(f"❌ {name} 列表获取失败")
+        return []
         
-        if not success:
-            print(f" [Page {page} Failed] ", end="")
-            break
-            
-        try:
-            if res_json and res_json.get('data') and res_json['data'].get('diff'):
-                data = res_json['data']['diff']
-                for item in data:
-                    item['type'] = name
-                sectors.extend(data)
-                print(".", end="", flush=True)
-                if len(data) < page_size: break
-                page += 1
-                time.sleep(0.1)
-            else:
-                break
-        except: break
+    sectors = []
+    if res_json and res_json.get('data') and res_json['data'].get('diff'):
+        sectors = res_json['data']['diff']
+        for item in sectors:
+            item['type'] = name
             
-    print(f" -> {len(sectors)} 个")
+    print(f"{name} 列表 -> {len(sectors)} 个")
     return sectors
 
 def get_sector_list():
     all_sectors = []
     targets = {"行业": "m:90 t:2", "概念": "m:90 t:3", "地域": "m:90 t:1"}
-    for name, fs in targets.items():
-        data = get_sector_list_raw(name, fs)
-        all_sectors.extend(data)
+    # 三个分类互不依赖，并发抓取，共用 sess 的连接池
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        for data in pool.map(lambda kv: get_sector_list_raw(*kv), targets.items()):
+            all_sectors.extend(data)
     
     df = pd.DataFrame(all_sectors)
     if df.empty: return pd.DataFrame()
     return df.rename(columns={'f12': 'code', 'f13': 'market', 'f14': 'name'})
 
-def get_kline_history(secid, clean_code):
-    """获取 K 线历史"""
-    params = {
-        "secid": secid,
-        "fields1": "f1,f2,f3,f4,f5,f6",
-        "fields2": "f51,f52,f53,f54,f55,f56,f57,f58", # 日期,开,收,高,低,量,额,换手
-        "klt": "101", "fqt": "1", "beg": "19900101", "end": "20500101", "lmt": "1000000"
-    }
-    
+def parse_klines(klines, columns, clean_code):
+    """把 "日期,值,值..." 形式的 klines 交给 C 版 CSV 解析器一次性解析"""
+    if not klines: return pd.DataFrame()
+    # 只取需要的前几列，接口多返回的尾部字段直接跳过
+    df = pd.read_csv(
+        io.StringIO('\n'.join(klines)), header=None, names=['date'] + columns,
+        usecols=range(len(columns) + 1),
+        dtype={c: 'float32' for c in columns}, na_values=['-', ''],
+        parse_dates=['date'], date_format='%Y-%m-%d', engine='c'
+    )
+    df['code'] = clean_code
+    return df
+
+def get_kline_history(secid, clean_code, beg=FULL_BEG):
+    """获取 K 线历史 (beg 之后的部分)；接口正常但没有数据返回空表，请求失败 (重试用尽/解析出错) 返回 None"""
     try:
         if CF_WORKER_URL:
-            params["target_func"] = "kline"
-            res = sess.get(CF_WORKER_URL, params=params, timeout=30).json()
+            url = f"{CF_WORKER_URL}?target_func=kline&secid={secid}&beg={beg}&{KLINE_QS}"
+            res = fetch_json(url, timeout=30)
         else:
-            url = "http://push2his.eastmoney.com/api/qt/stock/kline/get"
-            res = sess.get(url, params=params, timeout=10).json()
+            url = f"{KLINE_URL}?secid={secid}&beg={beg}&{KLINE_QS}"
+            res = fetch_json(url, timeout=10)
         
         if res and res.get('data') and res['data'].get('klines'):
-            klines = res['data']['klines']
-            data = [x.split(',') for x in klines]
-            df = pd.DataFrame(data, columns=['date', 'open', 'close', 'high', 'low', 'volume', 'amount', 'turnover'])
-            df['code'] = clean_code
             cols = ['open', 'close', 'high', 'low', 'volume', 'amount', 'turnover']
-            df[cols] = df[cols].apply(pd.to_numeric, errors='coerce')
-            return df
+            return parse_klines(res['data']['klines'], cols, clean_code)
     except Exception as e:
         # print(f"Kline err {clean_code}: {e}")
-        pass
+        return None
     return pd.DataFrame()
 
 def get_flow_history(secid, clean_code):
     """【新增】获取资金流历史"""
-    # 字段映射：
-    # f51:日期, f52:主力净流入, f53:小单, f54:中单, f55:大单, f56:超大单
-    params = {
-        "secid": secid,
-        "fields1": "f1,f2,f3,f7",
-        "fields2": "f51,f52,f53,f54,f55,f56", 
-        "klt": "101", "lmt": "0" # 0代表全量
-    }
-    
     try:
         if CF_WORKER_URL:
-            params["target_func"] = "flow" # 调用 Worker 的 flow 接口
-            res = sess.get(CF_WORKER_URL, params=params, timeout=30).json()
+            # 调用 Worker 的 flow 接口
+            url = f"{CF_WORKER_URL}?target_func=flow&secid={secid}&{FLOW_QS}"
+            res = fetch_json(url, timeout=30)
         else:
-            url = "http://push2his.eastmoney.com/api/qt/stock/fflow/daykline/get"
-            res = sess.get(url, params=params, timeout=10).json()
+            url = f"{FLOW_URL}?secid={secid}&{FLOW_QS}"
+            res = fetch_json(url, timeout=10)
             
         if res and res.get('data') and res['data'].get('klines'):
-            klines = res['data']['klines']
-            data = [x.split(',') for x in klines]
-            df = pd.DataFrame(data, columns=['date', 'main_net_flow', 'small_net_flow', 'medium_net_flow', 'large_net_flow', 'super_large_net_flow'])
-            
             # 计算 net_flow_amount (主力 = 超大+大)
             # 东财接口里 f52 已经是主力净流入
-            df.rename(columns={'main_net_flow': 'net_flow_amount'}, inplace=True) 
             # 兼容性：这里我们将 net_flow_amount 视为主力净流入，与个股保持一致
             # 个股表中 net_flow_amount 是全单净流入吗？通常主力净流入更有价值。
             # 为了统一，我们把 f52 映射为 main_net_flow
-            
-            df['code'] = clean_code
             cols = ['net_flow_amount', 'small_net_flow', 'medium_net_flow', 'large_net_flow', 'super_large_net_flow']
-            df[cols] = df[cols].apply(pd.to_numeric, errors='coerce')
+            df = parse_klines(res['data']['klines'], cols, clean_code)
             
             # 这里额外生成一个 main_net_flow 字段，等于 net_flow_amount (东财定义f52即主力)
             df['main_net_flow'] = df['net_flow_amount']
@@ -168,40 +218,128 @@ def get_flow_history(secid, clean_code):
         pass
     return pd.DataFrame()
 
-def process_one_sector(code, market):
+def load_history():
+    """读取已有宽表，按板块切成零拷贝的 Arrow 切片"""
+    if not os.path.exists(OUTPUT_FILE): return {}
+    try:
+        table = pq.read_table(OUTPUT_FILE).sort_by([('code', 'ascending'), ('date', 'ascending')])
+    except Exception as e:
+        print(f"⚠️ 读取已有宽表失败，改为全量下载: {e}")
+        return {}
+    if table.num_rows == 0: return {}
+    
+    codes = table.column('code').to_numpy(zero_copy_only=False)
+    bounds = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+    starts = np.r_[0, bounds]
+    ends = np.r_[bounds, len(codes)]
+    return {codes[s]: table.slice(s, e - s) for s, e in zip(starts, ends)}
+
+def to_table(df, schema=SECTOR_SCHEMA):
+    """按固定 schema 转为 Arrow 表 (缺失列补空；safe=False 跳过逐值校验)"""
+    return pa.Table.from_pandas(df.reindex(columns=schema.names), schema=schema, preserve_index=False, safe=False)
+
+def staged(tbl, is_new):
+    """K 线暂存行：按 KLINE_STAGE_SCHEMA 补上 is_new 标记"""
+    tbl = tbl.select(SECTOR_SCHEMA.names).cast(SECTOR_SCHEMA)
+    return tbl.append_column('is_new', pa.repeat(pa.scalar(is_new), tbl.num_rows))
+
+def settled_date(ts):
+    """时间戳 ts 时已收盘定型的最新日期：北京时间 SETTLE_TIME 之后当天算定型，之前只到前一天"""
+    bj = pd.Timestamp(ts, unit='s', tz='UTC').tz_convert('Asia/Shanghai')
+    return bj.date() if bj.time() >= SETTLE_TIME else bj.date() - datetime.timedelta(days=1)
+
+def merge_output(kline_file, flow_file, dst):
+    """K 线与资金流两路暂存文件用 DuckDB 一次性 Left Join，按 (code, date) 排序后替换正式文件
+
+    K 线暂存里的历史行自带资金流列；有资金流数据的板块缺失日期补 0，
+    完全没有资金流的板块保持 NaN。
+    增量下载会重新请求历史的最后一天 (可能是盘中写入的未完成 K 线)，同一 (code, date) 的
+    历史行与下载行先合成一行：行情取下载的，资金流下载行没有时沿用历史行的。
+    """
+    merged_file = f"{dst}.merged"
+    con = duckdb.connect()
+    con.execute("SET memory_limit='2GB'")
+    con.execute("SET preserve_insertion_order=false")  # 输出顺序由 COPY 里的 ORDER BY 保证
+    kline_exprs = ", ".join(
+        f"COALESCE(max({c}) FILTER (WHERE is_new), max({c}) FILTER (WHERE NOT is_new)) AS {c}" if c in FLOW_COLUMNS
+        else f"first({c} ORDER BY is_new DESC) AS {c}"
+        for c in SECTOR_COLUMNS if c not in ('code', 'date')
+    )
+    kline = f"(SELECT code, date, {kline_exprs} FROM read_parquet('{kline_file}') GROUP BY code, date)"
+    if flow_file:
+        flow_exprs = ",\n            ".join(
+            f"COALESCE(f.{c}, k.{c}, CASE WHEN fc.code IS NOT NULL THEN 0 END)::FLOAT AS {c}"
+            for c in FLOW_COLUMNS
+        )
+        base_cols = ", ".join(f"k.{c}" for c in SECTOR_COLUMNS if c not in FLOW_COLUMNS)
+        # 资金流暂存只读一次：物化后既用于关联，也用于判断板块有没有资金流
+        query = f"""
+            WITH flow AS MATERIALIZED (SELECT * FROM read_parquet('{flow_file}'))
+            SELECT {base_cols},
+            {flow_exprs}
+            FROM {kline} k
+            LEFT JOIN flow f USING (code, date)
+            LEFT JOIN (SELECT DISTINCT code FROM flow) fc ON fc.code = k.code
+        """
+    else:
+        query = f"SELECT * FROM {kline}"
+    cols = ", ".join(SECTOR_COLUMNS)
+    con.execute(f"""
+        COPY (SELECT {cols} FROM ({query}) ORDER BY code, date)
+        TO '{merged_file}' (FORMAT PARQUET, COMPRESSION ZSTD, COMPRESSION_LEVEL {ZSTD_LEVEL}, ROW_GROUP_SIZE {ROW_GROUP_SIZE})
+    """)
+    con.close()
+    os.replace(merged_file, dst)
+    os.remove(kline_file)
+    if flow_file: os.remove(flow_file)
+
+def load_secid_cache():
+    """读取 secid 格式缓存，过期的失效记录丢弃"""
+    if not os.path.exists(SECID_CACHE_FILE): return
+    try:
+        with open(SECID_CACHE_FILE, 'rb') as f:
+            cache = orjson.loads(f.read())
+        secid_fmt.update(cache.get('fmt', {}))
+        now = time.time()
+        dead_codes.update({c: ts for c, ts in cache.get('dead', {}).items() if now - ts < DEAD_CODE_TTL})
+    except:
+        pass
+
+def save_secid_cache():
+    with open(SECID_CACHE_FILE, 'wb') as f:
+        f.write(orjson.dumps({'fmt': secid_fmt, 'dead': dead_codes}))
+
+def process_one_sector(code, market, beg=FULL_BEG):
+    """下载单个板块，返回 (K 线, 资金流, failed)；failed 表示拿不到 K 线是因为请求失败，而不是接口确实没有数据"""
     clean_code = str(code)
-    # 构造 secid
-    if str(market) == '90' and not clean_code.startswith('BK'):
-        secid = f"{market}.BK{clean_code}"
+    # 构造 secid；只有 BK 是我们自己补上的，才有必要回退去掉它再试
+    added_bk = str(market) == '90' and not clean_code.startswith('BK')
+    if added_bk:
+        # 上次成功的写法优先
+        fmts = ['nobk', 'bk'] if secid_fmt.get(clean_code) == 'nobk' else ['bk', 'nobk']
     else:
-        secid = f"{market}.{clean_code}"
+        fmts = ['nobk']
         
-    # 1. 下载 K 线
-    df_k = get_kline_history(secid, clean_code)
-    
-    # 2. 备用 secid 尝试 (处理 BK 前缀不一致)
-    if df_k.empty and ".BK" in secid:
-        alt_secid = secid.replace(".BK", ".")
-        df_k = get_kline_history(alt_secid, clean_code)
-        if not df_k.empty:
-            secid = alt_secid # 修正 secid 用于后续资金流下载
+    # 1. 下载 K 线 (必要时换 secid 写法再试，处理 BK 前缀不一致)
+    df_k = pd.DataFrame()
+    failed = False
+    for fmt in fmts:
+        secid = f"{market}.BK{clean_code}" if fmt == 'bk' else f"{market}.{clean_code}"
+        df_k = get_kline_history(secid, clean_code, beg)
+        if df_k is None:
+            failed = True
+            df_k = pd.DataFrame()
+        elif not df_k.empty:
+            secid_fmt[clean_code] = fmt # secid 同时用于后续资金流下载
+            break
 
-    if df_k.empty: return pd.DataFrame()
+    if df_k.empty:
+        # 是否记为失效板块由主循环在所有轮次结束后决定
+        return pd.DataFrame(), pd.DataFrame(), failed
 
-    # 3. 下载 资金流
+    # 3. 下载 资金流 (合并留到最后由 DuckDB 统一完成)
     df_f = get_flow_history(secid, clean_code)
-    
-    # 4. 合并 (Left Join)
-    if not df_f.empty:
-        df_merged = pd.merge(df_k, df_f, on=['date', 'code'], how='left')
-        # 填充 NaN 为 0 (早期没有资金流数据)
-        flow_cols = ['net_flow_amount', 'main_net_flow', 'super_large_net_flow', 'large_net_flow', 'medium_net_flow', 'small_net_flow']
-        for c in flow_cols:
-            if c in df_merged.columns:
-                df_merged[c] = df_merged[c].fillna(0)
-        return df_merged
-    
-    return df_k
+    return df_k, df_f, False
 
 def main():
     if CF_WORKER_URL:
@@ -209,64 +347,126 @@ def main():
     else:
         print("🐢 直连模式")
 
-    # 1. 获取列表
+    # 1. 获取列表 (优先复用未过期的本地快照)
     print("Step 1: 获取全市场板块列表...")
-    df_list = get_sector_list()
-    if df_list.empty:
-        print("❌ 列表获取失败")
-        return
+    if os.path.exists(LIST_FILE) and time.time() - os.path.getmtime(LIST_FILE) < LIST_CACHE_TTL:
+        df_list = pd.read_parquet(LIST_FILE)
+        print(f"♻️ 复用本地板块列表快照: {LIST_FILE}")
+    else:
+        df_list = get_sector_list()
+        if df_list.empty:
+            print("❌ 列表获取失败")
+            return
+        df_list.drop_duplicates(subset=['code'], inplace=True)
+        df_list.to_parquet(LIST_FILE, index=False)
     
-    df_list.drop_duplicates(subset=['code'], inplace=True)
     unique_count = len(df_list)
     print(f"✅ 最终有效目标: {unique_count} 个")
     
-    df_list.to_parquet(f"{OUTPUT_DIR}/sector_list.parquet", index=False)
+    history = load_history()
+    last_dates = {c: t.column('date')[-1].as_py() for c, t in history.items()}
+    # 最新一根 K 线已是今天且写入时已收盘 (宽表在今天 SETTLE_TIME 之后生成)，无需再请求
+    up_to_date = set()
+    if last_dates:
+        print(f"📈 增量模式: {len(last_dates)} 个板块已有历史，从最后一天起重新下载 (覆盖可能的盘中数据)")
+        today = pd.Timestamp.now(tz='Asia/Shanghai').date()
+        if settled_date(os.path.getmtime(OUTPUT_FILE)) >= today:
+            up_to_date = {c for c, d in last_dates.items() if d >= today}
+        if up_to_date:
+            print(f"⏭️ {len(up_to_date)} 个板块今日收盘数据已入库，跳过")
     
-    # 2. 循环补录
-    all_dfs = []
-    downloaded_codes = set()
+    # 2. 循环补录 (边下载边写入 K 线 / 资金流两路暂存文件)
+    kline_file = f"{OUTPUT_DIR}/sector_kline.parquet.tmp"
+    flow_file = f"{OUTPUT_DIR}/sector_flow.parquet.tmp"
+    writer = None
+    flow_writer = None
+    downloaded_codes = set(up_to_date)
+    # 全量下载时接口明确返回无数据的板块；全部轮次后仍未成功的才记为失效
+    empty_codes = set()
     MAX_ROUNDS = 3
     
+    load_secid_cache()
+    targets = [
+        (c, m) for c, m in zip(df_list['code'].tolist(), df_list['market'].tolist())
+        if str(c) not in dead_codes
+    ]
+    if len(targets) < unique_count:
+        print(f"⏭️ 跳过 {unique_count - len(targets)} 个近期拉取失败的板块")
+    
     for round_num in range(1, MAX_ROUNDS + 1):
-        pending_df = df_list[~df_list['code'].isin(downloaded_codes)]
-        if pending_df.empty:
+        pending = [(c, m) for c, m in targets if c not in downloaded_codes]
+        if not pending:
             print("✨ 所有板块已全部下载完成！")
             break
             
-        print(f"\n🔄 第 {round_num}/{MAX_ROUNDS} 轮下载 (剩余 {len(pending_df)} 个)...")
+        print(f"\n🔄 第 {round_num}/{MAX_ROUNDS} 轮下载 (剩余 {len(pending)} 个)...")
         
-        count = 0
-        for _, row in pending_df.iterrows():
+        def fetch_one(row):
+            code, market = row
+            last_date = last_dates.get(code)
+            # 从最后一天起重下：盘中写入的当天 K 线在收盘后被覆盖
+            beg = pd.Timestamp(last_date).strftime('%Y%m%d') if last_date else FULL_BEG
             # 同时下载 K线 + 资金流
-            df = process_one_sector(row['code'], row['market'])
-            
-            if not df.empty:
-                all_dfs.append(df)
-                downloaded_codes.add(row['code'])
-            
-            count += 1
-            if count % 50 == 0:
-                print(f"   进度: {count}/{len(pending_df)} | 成功: {len(downloaded_codes)}")
-            
-            time.sleep(0.05)
+            return code, last_date, process_one_sector(code, market, beg)
+        
+        # 网络请求并发执行，谁先完成谁先写 (最终由 DuckDB 排序)，写文件只在主线程进行
+        count = 0
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+            futures = [pool.submit(fetch_one, row) for row in pending]
+            for fut in as_completed(futures):
+                code, last_date, (df_k, df_f, failed) = fut.result()
+                if not df_k.empty:
+                    dead_codes.pop(str(code), None)
+                    empty_codes.discard(code)
+                    table = to_table(df_k)
+                    if writer is None:
+                        writer = pq.ParquetWriter(kline_file, KLINE_STAGE_SCHEMA, compression='zstd', compression_level=ZSTD_LEVEL)
+                    hist = history.pop(code, None)
+                    if hist is not None:
+                        writer.write_table(staged(hist, False))
+                    writer.write_table(staged(table, True))
+                    if not df_f.empty:
+                        flow_table = to_table(df_f, FLOW_SCHEMA)
+                        if flow_writer is None:
+                            flow_writer = pq.ParquetWriter(flow_file, FLOW_SCHEMA, compression='zstd', compression_level=ZSTD_LEVEL)
+                        flow_writer.write_table(flow_table)
+                    downloaded_codes.add(code)
+                elif failed:
+                    # 请求失败 (网络/代理异常)，留给下一轮重试，不据此判断板块失效
+                    empty_codes.discard(code)
+                elif last_date:
+                    # 已有历史且没有新数据，视为已是最新
+                    downloaded_codes.add(code)
+                else:
+                    empty_codes.add(code)
+
+                count += 1
+                if count % 50 == 0:
+                    print(f"   进度: {count}/{len(pending)} | 成功: {len(downloaded_codes)}")
     
-    # 3. 合并保存
+    # 3. 收尾写出
+    # 全量下载在最后仍明确无数据的板块记为失效，TTL 内跳过；只是请求失败的不记
+    now = time.time()
+    for code in empty_codes - downloaded_codes:
+        dead_codes[str(code)] = now
+    save_secid_cache()
     print(f"\n📊 最终统计: 目标 {unique_count} -> 成功 {len(downloaded_codes)}")
     
-    if all_dfs:
-        print("正在合并宽表...")
-        full_df = pd.concat(all_dfs, ignore_index=True)
-        full_df.sort_values(['code', 'date'], inplace=True)
-        
-        # 压缩类型
-        float_cols = full_df.select_dtypes(include=['float64']).columns
-        full_df[float_cols] = full_df[float_cols].astype('float32')
-        
-        outfile = f"{OUTPUT_DIR}/sector_full.parquet"
-        full_df.to_parquet(outfile, index=False, compression='zstd')
-        print(f"✅ 文件已生成: {outfile}")
-        print(f"   总记录数: {len(full_df)}")
-        print(f"   包含资金流列: {'net_flow_amount' in full_df.columns}")
+    if writer is not None:
+        # 没有新数据的板块原样保留历史
+        for hist in history.values():
+            writer.write_table(staged(hist, False))
+        writer.close()
+        if flow_writer is not None:
+            flow_writer.close()
+            merge_output(kline_file, flow_file, OUTPUT_FILE)
+        else:
+            merge_output(kline_file, None, OUTPUT_FILE)
+        print(f"✅ 文件已生成: {OUTPUT_FILE}")
+        # 重叠日期已合并，以落盘文件的行数为准
+        print(f"   总记录数: {pq.ParquetFile(OUTPUT_FILE).metadata.num_rows}")
+    elif history:
+        print(f"✅ 没有新数据，保留已有文件: {OUTPUT_FILE}")
     else:
         print("❌ 严重错误：未下载到数据！")
 
@@ -0,0 +1,336 @@
+# scripts/indicators_numba.py
+# 技术指标的 Numba 实现，口径与 pandas_ta 默认参数一致：
+#   EMA  : 前 length 个值的 SMA 作种子，之后 ewm(adjust=False)
+#   RMA  : ewm(alpha=1/length, min_periods=length, adjust=True)
+#   MACD : 列顺序 dif / macd(柱) / dea
+#   KDJ  : fastk 经两次 RMA(signal) 得到 K、D，J = 3K - 2D
+#   BOLL : SMA ± std * 总体标准差 (ddof=0)
+#   CCI  : (hlc3 - SMA) / (0.015 * 平均绝对偏差)
+#   ATR  : 真实波幅的 RMA
+# 输入可以是 float32 或 float64 数组 (按类型各编译一份)，累加与输出统一用 float64，
+# 长度不足时返回全 NaN (与 pandas_ta 返回 None 后列为空一致)
+import sys
+import numpy as np
+from numba import njit, prange
+
+EPS = sys.float_info.epsilon
+
+@njit(cache=True)
+def _nan_like(x):
+    out = np.empty(len(x))
+    out[:] = np.nan
+    return out
+
+@njit(cache=True)
+def _ewm(x, alpha, adjust, min_periods):
+    """等价于 pandas Series.ewm(alpha=alpha, adjust=adjust, min_periods=min_periods).mean()"""
+    n = len(x)
+    out = _nan_like(x)
+    if n == 0: return out
+    old_wt_factor = 1.0 - alpha
+    new_wt = 1.0 if adjust else alpha
+    min_periods = max(min_periods, 1)
+
+    weighted = x[0]
+    nobs = 1 if x[0] == x[0] else 0
+    old_wt = 1.0
+    if nobs >= min_periods: out[0] = weighted
+    for i in range(1, n):
+        cur = x[i]
+        is_obs = cur == cur
+        if is_obs: nobs += 1
+        if weighted == weighted:
+            old_wt *= old_wt_factor
+            if is_obs:
+                if weighted != cur:
+                    # 等价于 (old_wt * weighted + new_wt * cur) / (old_wt + new_wt)；
+                    # 除法只依赖权重，不在 weighted 的递推链上，每步递推只剩一次乘加
+                    weighted += (cur - weighted) * (new_wt / (old_wt + new_wt))
+                if adjust:
+                    old_wt += new_wt
+                else:
+                    old_wt = 1.0
+        elif is_obs:
+            weighted = cur
+        if nobs >= min_periods: out[i] = weighted
+    return out
+
+@njit(cache=True)
+def ema(x, length):
+    """EMA (SMA 种子)"""
+    n = len(x)
+    if n < length: return _nan_like(x)
+    seeded = x.copy()
+    s = 0.0
+    cnt = 0
+    for i in range(length):
+        if x[i] == x[i]:
+            s += x[i]
+            cnt += 1
+    seeded[:length - 1] = np.nan
+    seeded[length - 1] = s / cnt if cnt > 0 else np.nan
+    return _ewm(seeded, 2.0 / (length + 1.0), False, 0)
+
+@njit(cache=True)
+def rma(x, length):
+    """Wilder 平滑"""
+    return _ewm(x, 1.0 / length, True, length)
+
+@njit(cache=True)
+def rolling_mean(x, length):
+    """rolling(length).mean()，窗口内有 NaN 则为 NaN；滑动累加，O(N)"""
+    n = len(x)
+    out = _nan_like(x)
+    s = 0.0
+    nans = 0
+    for i in range(n):
+        v = x[i]
+        if v == v: s += v
+        else: nans += 1
+        if i >= length:
+            old = x[i - length]
+            if old == old: s -= old
+            else: nans -= 1
+        if i >= length - 1 and nans == 0:
+            out[i] = s / length
+    return out
+
+@njit(cache=True, parallel=True)
+def grouped_rolling_mean(x, starts, length):
+    """多只股票首尾相接 (starts 为每只股票的起始下标) 时逐段求 rolling_mean，窗口不跨股票；各段互不依赖，按股票并行"""
+    n = len(x)
+    out = _nan_like(x)
+    for g in prange(len(starts)):
+        a = starts[g]
+        b = starts[g + 1] if g + 1 < len(starts) else n
+        out[a:b] = rolling_mean(x[a:b], length)
+    return out
+
+@njit(cache=True)
+def rolling_std(x, length, ddof):
+    """滑动 Welford (加入/移出时更新均值与离差平方和，同 pandas)，O(N)"""
+    n = len(x)
+    out = _nan_like(x)
+    nobs = 0
+    mean = 0.0
+    ssqdm = 0.0
+    nans = 0
+    for i in range(n):
+        v = x[i]
+        if v == v:
+            nobs += 1
+            delta = v - mean
+            mean += delta / nobs
+            ssqdm += delta * (v - mean)
+        else: nans += 1
+        if i >= length:
+            old = x[i - length]
+            if old == old:
+                nobs -= 1
+                if nobs > 0:
+                    delta = old - mean
+                    mean -= delta / nobs
+                    ssqdm -= delta * (old - mean)
+                else:
+                    mean = 0.0
+                    ssqdm = 0.0
+            else: nans -= 1
+        if i >= length - 1 and nans == 0:
+            out[i] = np.sqrt(max(ssqdm, 0.0) / (length - ddof))
+    return out
+
+@njit(cache=True)
+def _rolling_extreme(x, length, is_max):
+    """单调队列求滑动最大/最小值，窗口内有 NaN 则为 NaN，O(N)"""
+    n = len(x)
+    out = _nan_like(x)
+    q = np.empty(n, dtype=np.int64)
+    head = 0
+    tail = 0
+    last_nan = -1
+    for i in range(n):
+        v = x[i]
+        if v != v:
+            last_nan = i
+        else:
+            while tail > head and ((x[q[tail - 1]] <= v) if is_max else (x[q[tail - 1]] >= v)):
+                tail -= 1
+            q[tail] = i
+            tail += 1
+        while tail > head and q[head] <= i - length:
+            head += 1
+        if i >= length - 1 and last_nan <= i - length:
+            out[i] = x[q[head]]
+    return out
+
+@njit(cache=True)
+def rolling_max(x, length):
+    return _rolling_extreme(x, length, True)
+
+@njit(cache=True)
+def rolling_min(x, length):
+    return _rolling_extreme(x, length, False)
+
+@njit(cache=True)
+def _non_zero_range(high, low):
+    """high - low；只要出现 0 就整列加 epsilon (pandas_ta non_zero_range)"""
+    diff = np.empty(len(high))
+    for i in range(len(diff)):
+        diff[i] = high[i] - low[i]
+    for i in range(len(diff)):
+        if diff[i] == 0:
+            return diff + EPS
+    return diff
+
+@njit(cache=True)
+def macd(close, fast=12, slow=26, signal=9):
+    """返回 (dif, macd 柱, dea)"""
+    n = len(close)
+    nan = _nan_like(close)
+    if n < max(fast, slow, signal): return nan, nan.copy(), nan.copy()
+    dif = ema(close, fast) - ema(close, slow)
+    first = -1
+    for i in range(n):
+        if dif[i] == dif[i]:
+            first = i
+            break
+    if first < 0 or n - first < signal: return nan, nan.copy(), nan.copy()
+    dea = _nan_like(close)
+    dea[first:] = ema(dif[first:], signal)
+    return dif, dif - dea, dea
+
+@njit(cache=True)
+def kdj(high, low, close, length=9, signal=3):
+    """返回 (k, d, j)"""
+    if len(close) < length:
+        nan = _nan_like(close)
+        return nan, nan.copy(), nan.copy()
+    hh = rolling_max(high, length)
+    ll = rolling_min(low, length)
+    fastk = 100.0 * (close - ll) / _non_zero_range(hh, ll)
+    k = rma(fastk, signal)
+    d = rma(k, signal)
+    return k, d, 3.0 * k - 2.0 * d
+
+@njit(cache=True)
+def _gains(close):
+    """逐日涨跌拆成 (涨幅, 跌幅) 两列，不同周期的 RSI 共用"""
+    n = len(close)
+    pos = np.zeros(n)
+    neg = np.zeros(n)
+    if n == 0: return pos, neg
+    pos[0] = np.nan
+    neg[0] = np.nan
+    for i in range(1, n):
+        d = close[i] - close[i - 1]
+        if d != d:
+            pos[i] = np.nan
+            neg[i] = np.nan
+        elif d > 0:
+            pos[i] = d
+        else:
+            neg[i] = d
+    return pos, neg
+
+@njit(cache=True, error_model='numpy')
+def _rsi(pos, neg, length):
+    if len(pos) < length: return _nan_like(pos)
+    pos_avg = rma(pos, length)
+    neg_avg = rma(neg, length)
+    return 100.0 * pos_avg / (pos_avg + np.abs(neg_avg))
+
+@njit(cache=True)
+def rsi(close, length=14):
+    pos, neg = _gains(close)
+    return _rsi(pos, neg, length)
+
+@njit(cache=True)
+def bbands(close, length=20, std=2.0):
+    """返回 (下轨, 上轨)"""
+    if len(close) < length:
+        nan = _nan_like(close)
+        return nan, nan.copy()
+    dev = std * rolling_std(close, length, 0)
+    mid = rolling_mean(close, length)
+    return mid - dev, mid + dev
+
+@njit(cache=True, error_model='numpy')
+def cci(high, low, close, length=14, c=0.015):
+    n = len(close)
+    out = _nan_like(close)
+    if n < length: return out
+    tp = (high + low + close) / 3.0
+    mean_tp = rolling_mean(tp, length)
+    for i in range(length - 1, n):
+        m = mean_tp[i]
+        if m != m: continue
+        # 平均绝对偏差 (以窗口自身均值为中心)
+        mad = 0.0
+        for j in range(i - length + 1, i + 1):
+            mad += abs(tp[j] - m)
+        mad /= length
+        out[i] = (tp[i] - m) / (c * mad)
+    return out
+
+@njit(cache=True)
+def atr(high, low, close, length=14):
+    n = len(close)
+    if n < length: return _nan_like(close)
+    hl = _non_zero_range(high, low)
+    tr = _nan_like(close)
+    for i in range(1, n):
+        # 三者取最大，忽略 NaN
+        m = np.nan
+        pc = np.float64(close[i - 1])
+        for v in (abs(hl[i]), abs(high[i] - pc), abs(pc - low[i])):
+            if v == v and (m != m or v > m):
+                m = v
+        tr[i] = m
+    return rma(tr, length)
+
+# ta_block 输出行的顺序 (merge_data.TA_COLUMNS 与此一致)
+TA_NAMES = ('dif', 'macd', 'dea', 'k', 'd', 'j', 'rsi6', 'rsi12', 'rsi24', 'boll_lb', 'boll_up', 'cci', 'atr')
+
+@njit(cache=True)
+def ta_block(close, high, low):
+    """单只股票的 MACD / KDJ / RSI / BOLL / CCI / ATR，按 TA_NAMES 顺序写成 (13, N) 的二维数组"""
+    out = np.empty((len(TA_NAMES), len(close)))
+    out[0], out[1], out[2] = macd(close, 12, 26, 9)
+    out[3], out[4], out[5] = kdj(high, low, close, 9, 3)
+    pos, neg = _gains(close)
+    out[6] = _rsi(pos, neg, 6)
+    out[7] = _rsi(pos, neg, 12)
+    out[8] = _rsi(pos, neg, 24)
+    out[9], out[10] = bbands(close, 20, 2.0)
+    out[11] = cci(high, low, close, 14)
+    out[12] = atr(high, low, close, 14)
+    return out
+
+@njit(cache=True, parallel=True)
+def grouped_ta_block(close, high, low, starts):
+    """多只股票首尾相接时逐段求 ta_block，整批一次调用，不回到 Python 逐股循环；递推只在段内，按股票并行"""
+    n = len(close)
+    out = np.empty((len(TA_NAMES), n))
+    for g in prange(len(starts)):
+        a = starts[g]
+        b = starts[g + 1] if g + 1 < len(starts) else n
+        out[:, a:b] = ta_block(close[a:b], high[a:b], low[a:b])
+    return out
+
+def _warmup():
+    """导入时用小数组触发编译 (cache=True 时后续进程直接读缓存)"""
+    for dtype in (np.float32, np.float64):
+        x = np.linspace(1.0, 2.0, 64).astype(dtype)
+        hi, lo = x + dtype(0.1), x - dtype(0.1)
+        macd(x)
+        kdj(hi, lo, x)
+        rsi(x, 6)
+        bbands(x)
+        cci(hi, lo, x)
+        atr(hi, lo, x)
+        rolling_mean(x, 5)
+        grouped_rolling_mean(x, np.array([0, 30], dtype=np.int64), 5)
+        ta_block(x, hi, lo)
+        grouped_ta_block(x, hi, lo, np.array([0, 30], dtype=np.int64))
+
+_warmup()
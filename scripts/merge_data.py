@@ -1,15 +1,17 @@
 # scripts/merge_data.py
 import duckdb
 import pandas as pd
-import pandas_ta as ta
 import numpy as np
 import os
-import glob
 import datetime
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 from tqdm import tqdm
-import gc
+import indicators_numba as ind
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 # === 路径配置 ===
 CACHE_DIR = "cache_data"          
@@ -19,325 +21,550 @@ FLOW_DIR = "downloaded_fundflow"
 # 输出目录
 OUTPUT_ENGINE = "final_output/engine"
 OUTPUT_DAILY = f"{OUTPUT_ENGINE}/stock_daily" 
+# buffer 保持 Parquet 而不用 DuckDB 原生库文件：duckdb 未锁版本 (CI 用 --pre 安装)，
+# 原生存储格式跨版本不保证可读，而 buffer 要经 Actions Cache 跨天恢复
 CACHE_OUTPUT_FILE = f"{CACHE_DIR}/stock_buffer.parquet" 
 
 os.makedirs(OUTPUT_DAILY, exist_ok=True)
 
+# 历史数据按批流式读取的行数
+HISTORY_BATCH_ROWS = 1_000_000
+
+# 每个 row group 的行数：攒够再写 (每只股票写一次会产生大量碎片)，也不宜过大，
+# 数据按 code 连续存放，row group 内 code 范围越窄，按 code 查询时 min/max 统计跳过的越多
+ROW_GROUP_ROWS = 100_000
+
+# Parquet 写出参数：code/date 低基数走字典编码，浮点列高基数不走字典 (BYTE_STREAM_SPLIT 见 writer_options)；
+# data page v2 + 统计信息便于 DuckDB 按 code/date 剪枝
+ZSTD_LEVEL = 3
+PARQUET_OPTIONS = dict(
+    compression='zstd', compression_level=ZSTD_LEVEL,
+    use_dictionary=['code', 'date'], data_page_version='2.0', write_statistics=True,
+)
+
+# 逐股计算的进程数 (默认 CPU 核数，设为 1 则在主进程内串行)
+MERGE_WORKERS = int(os.getenv("MERGE_WORKERS", os.cpu_count() or 1))
+# 每个任务打包的股票数：单只股票只算几毫秒，逐只提交时序列化与进程间通信的开销占比不小
+MERGE_CHUNK = 16
+
+# 日线宽表的数值列 (统一 float32)
+FLOAT_COLS = [
+    'open', 'close', 'high', 'low', 'volume', 'amount', 'turn', 'pctChg', 
+    'peTTM', 'pbMRQ', 'adjustFactor', 'mkt_cap', 
+    'net_flow_amount', 'main_net_flow', 'super_large_net_flow', 'large_net_flow', 'medium_small_net_flow',
+    'ma5', 'ma10', 'ma20', 'ma60', 'ma120', 'ma250',
+    'vol_ma5', 'vol_ma10', 'vol_ma20', 'vol_ma30',
+    'dif', 'dea', 'macd', 'k', 'd', 'j', 'rsi6', 'rsi12', 'rsi24',
+    'boll_lb', 'boll_up', 'cci', 'atr'
+]
+DAILY_COLUMNS = ['date', 'code'] + FLOAT_COLS
+# 日线输出 Schema：date 存为 date32 (4 字节，可做谓词下推)，与板块宽表一致
+DAILY_SCHEMA = pa.schema([('date', pa.date32()), ('code', pa.string())] + [(c, pa.float32()) for c in FLOAT_COLS])
+FLOW_RAW_COLS = ['net_flow_amount', 'main_net_flow', 'super_large_net_flow', 'large_net_flow', 'medium_small_net_flow']
+
 # === DuckDB 初始化 ===
 con = duckdb.connect(database=':memory:')
 con.execute("SET memory_limit='4GB';") 
-con.execute("SET threads=2;")
+con.execute("SET threads=2;")  # 工作进程 import 时也会建连接，默认只开 2 线程；主进程在 main 里按阶段调整
+con.execute("SET preserve_insertion_order=false;")  # 需要顺序的查询都写了 ORDER BY，其余不必保序
+con.execute("SET enable_object_cache=true;")  # 历史文件先扫代码再扫全表，缓存 Parquet 元数据
+
+def parquet_source(files, filename=False):
+    """多个 Parquet 文件的 read_parquet 表达式 (文件列表写成 DuckDB 列表字面量，列按名字对齐；filename=True 时附带来源文件列)"""
+    return f"read_parquet({list(files)}, union_by_name=true{', filename=true' if filename else ''})"
+
+def walk_parquet(root, recursive=True):
+    """os.scandir 扫描目录 (默认递归)，返回 {文件名(去掉 .parquet): 路径} (与 glob 一样跳过隐藏文件)"""
+    found = {}
+    stack = [root]
+    while stack:
+        try: it = os.scandir(stack.pop())
+        except OSError: continue
+        with it:
+            for e in it:
+                if e.name.startswith('.'): continue
+                if e.is_dir():
+                    if recursive: stack.append(e.path)
+                elif e.name.endswith('.parquet'): found[e.name[:-8]] = e.path
+    return found
 
 def get_all_codes():
     """获取全量股票代码"""
     codes = set()
-    history_files = glob.glob(f"{CACHE_DIR}/*.parquet")
+    history_files = sorted(walk_parquet(CACHE_DIR, recursive=False).values())
     if history_files:
         print(f"📦 扫描历史文件: {len(history_files)} 个")
         try:
-            files_sql = str(history_files).replace('[', '').replace(']', '')
-            df_codes = con.execute(f"SELECT DISTINCT code FROM read_parquet({files_sql})").fetchdf()
-            codes.update(df_codes['code'].tolist())
+            # 直接取 Arrow 列，不经 pandas
+            tbl_codes = con.execute(f"SELECT DISTINCT code FROM {parquet_source(history_files)} WHERE code IS NOT NULL").fetch_arrow_table()
+            codes.update(tbl_codes.column('code').to_pylist())
         except Exception as e:
             print(f"⚠️ 读取历史代码失败: {e}")
 
-    kline_files = glob.glob(f"{KLINE_DIR}/**/*.parquet", recursive=True)
-    print(f"🔥 扫描今日增量: {len(kline_files)} 个")
-    for f in kline_files:
-        code = os.path.basename(f).replace('.parquet', '')
-        codes.add(code)
+    # 扫描的同时建立 code -> 文件 索引
+    kline_map = walk_parquet(KLINE_DIR)
+    print(f"🔥 扫描今日增量: {len(kline_map)} 个")
+    codes.update(kline_map)
         
-    return sorted(list(codes)), history_files, kline_files
+    return sorted(list(codes)), history_files, kline_map
+
+def iter_by_code(sql):
+    """执行按 code 排序的查询，流式逐只股票产出 (code, Arrow 表)
+
+    每只股票是所在批次的零拷贝切片；转 pandas 留给工作进程做。
+    """
+    reader = con.execute(sql).fetch_record_batch(HISTORY_BATCH_ROWS)
+    pending_code, pending = None, []
+    for batch in reader:
+        n = batch.num_rows
+        if n == 0: continue
+        # 相邻 code 比较在 Arrow 里完成，不把整列字符串转成 Python 对象
+        col = batch.column('code')
+        changed = pc.not_equal(col.slice(1), col.slice(0, n - 1)).to_numpy(zero_copy_only=False)
+        bounds = [0, *(np.flatnonzero(changed) + 1), n]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            code = col[start].as_py()
+            if code != pending_code and pending:
+                yield pending_code, pa.Table.from_batches(pending)
+                pending = []
+            pending_code = code
+            pending.append(batch.slice(start, end - start))
+    if pending:
+        yield pending_code, pa.Table.from_batches(pending)
+
+def scan_sorted(view):
+    """一次扫描视图，日期转时间戳并按 (code, date) 去重排序
+
+    历史里归档与 buffer 重叠的 (code, date) 在这里去掉：视图带 from_buffer 列，重叠时保留 buffer (较新) 的那行。
+    code 为空的脏行直接丢弃 (与 get_all_codes 一致)，不会排到末尾去和真实代码比较。
+    """
+    return iter_by_code(f"""
+        SELECT DISTINCT ON (code, date) * EXCLUDE (from_buffer)
+        FROM (SELECT * REPLACE (TRY_CAST(date AS TIMESTAMP) AS date) FROM {view})
+        WHERE date IS NOT NULL AND code IS NOT NULL
+        ORDER BY code, date, from_buffer DESC
+    """)
+
+def code_cursor(groups, name):
+    """把按 code 有序的 (code, 表) 流包装成 lookup(code)，没有该股票时返回 None；调用方须按 code 升序查询"""
+    state = {'it': groups, 'cur': None}
+    try:
+        state['cur'] = next(groups, None)
+    except Exception as e:
+        print(f"⚠️ 读取{name}失败: {e}")
+
+    def lookup(code):
+        found = None
+        # code 为空的分组无法与字符串比较，遇到即视为扫描结束
+        while state['cur'] is not None and state['cur'][0] is not None and state['cur'][0] <= code:
+            if state['cur'][0] == code:
+                found = state['cur'][1]
+            state['cur'] = next(state['it'], None)
+        return found
+    return lookup
+
+MA_WINDOWS = [5, 10, 20, 60, 120, 250]
+VOL_MA_WINDOWS = [5, 10, 20, 30]
 
 def calculate_indicators(df):
     """计算技术指标"""
     # 1. 价格均线
-    for w in [5, 10, 20, 60, 120, 250]:
-        df[f'ma{w}'] = df['close'].rolling(window=w).mean()
+    for w, ma in moving_averages(df['close'], MA_WINDOWS).items():
+        df[f'ma{w}'] = ma
     
     # 2. 成交量均线
-    for w in [5, 10, 20, 30]:
-        df[f'vol_ma{w}'] = df['volume'].rolling(window=w).mean()
+    for w, ma in moving_averages(df['volume'], VOL_MA_WINDOWS).items():
+        df[f'vol_ma{w}'] = ma
 
-    # 3. MACD
-    try:
-        macd = df.ta.macd(close='close', fast=12, slow=26, signal=9)
-        if macd is not None:
-            df['dif'] = macd.iloc[:, 0]
-            df['macd'] = macd.iloc[:, 1]
-            df['dea'] = macd.iloc[:, 2]
-    except: pass
-
-    # 4. KDJ
-    try:
-        kdj = df.ta.kdj(high='high', low='low', close='close', length=9, signal=3)
-        if kdj is not None:
-            df['k'] = kdj.iloc[:, 0]
-            df['d'] = kdj.iloc[:, 1]
-            df['j'] = kdj.iloc[:, 2]
-    except: pass
-
-    # 5. RSI
-    try:
-        df['rsi6'] = df.ta.rsi(close='close', length=6)
-        df['rsi12'] = df.ta.rsi(close='close', length=12)
-        df['rsi24'] = df.ta.rsi(close='close', length=24)
-    except: pass
+    return calculate_ta(df)
+
+def moving_averages(values, windows):
+    """各窗口的均线 (窗口内有 NaN 则为 NaN，与 rolling(w).mean() 一致)，与周/月线共用 Numba 滑动均值内核"""
+    x = np.asarray(values, dtype=np.float64)
+    return {w: ind.rolling_mean(x, w) for w in windows}
+
+def calculate_indicators_grouped(tbl, starts):
+    """多只股票拼在一起 (已按 code、date 排序) 的 Arrow 表计算指标：均线与其余指标都由 Numba 内核按股票边界整批算完，指标列以 float32 追加"""
+    # starts 为每只股票在表中的起始行号 (调用方拼表时已知，不必再把 code 列转成 Python 字符串比较)
+    close = tbl.column('close').to_numpy().astype(np.float32)
+    high = tbl.column('high').to_numpy().astype(np.float32)
+    low = tbl.column('low').to_numpy().astype(np.float32)
+    volume = tbl.column('volume').to_numpy().astype(np.float64)
+    out = {}
+    # 均线：Numba 内核在股票边界处重置滑动和，整列一次调用
+    for w in MA_WINDOWS:
+        out[f'ma{w}'] = ind.grouped_rolling_mean(close, starts, w)
+    for w in VOL_MA_WINDOWS:
+        out[f'vol_ma{w}'] = ind.grouped_rolling_mean(volume, starts, w)
+
+    out.update(zip(TA_COLUMNS, ind.grouped_ta_block(close, high, low, starts)))
+    for name in INDICATOR_COLS:
+        tbl = tbl.append_column(name, pa.array(out[name].astype(np.float32), from_pandas=True))
+    return tbl
+
+TA_COLUMNS = list(ind.TA_NAMES)
+INDICATOR_COLS = [f'ma{w}' for w in MA_WINDOWS] + [f'vol_ma{w}' for w in VOL_MA_WINDOWS] + TA_COLUMNS
+
+# buffer 只作为下次合并的历史输入，指标每次都会重算，不必落盘
+BUFFER_SCHEMA = pa.schema([f for f in DAILY_SCHEMA if f.name not in INDICATOR_COLS])
 
-    # 6. BOLL
+def ta_arrays(close, high, low):
+    """MACD / KDJ / RSI / BOLL / CCI / ATR (Numba 实现，口径同 pandas_ta)，返回 {列名: 数组}"""
+    return dict(zip(TA_COLUMNS, ind.ta_block(close, high, low)))
+
+def calculate_ta(df):
+    """单只股票的 MACD / KDJ / RSI / BOLL / CCI / ATR"""
     try:
-        boll = df.ta.bbands(close='close', length=20, std=2)
-        if boll is not None:
-            df['boll_lb'] = boll.iloc[:, 0]
-            df['boll_up'] = boll.iloc[:, 2]
-    except: pass
+        close = df['close'].to_numpy(np.float32)
+        high = df['high'].to_numpy(np.float32)
+        low = df['low'].to_numpy(np.float32)
+    except: return df
+    for name, values in ta_arrays(close, high, low).items():
+        df[name] = values
+    return df
+
+# 周/月线标签：W-FRI 取当周周五 (周末归下一个周五)，月线取月末，与 pandas resample 一致
+WEEK_LABEL_SQL = "day + CAST((12 - isodow(day)) % 7 AS INTEGER)"
+MONTH_LABEL_SQL = "last_day(day)"
+
+# 周/月线输出 Schema (列顺序即 resample_sql 的输出顺序，后接指标列)
+BAR_VALUE_COLS = [
+    'open', 'close', 'high', 'low', 'volume', 'amount', 'turn',
+    'peTTM', 'pbMRQ', 'mkt_cap', 'adjustFactor', 'net_flow_amount', 'main_net_flow'
+]
+BAR_SCHEMA = pa.schema(
+    [('date', pa.date32())] + [(c, pa.float32()) for c in BAR_VALUE_COLS]
+    + [('code', pa.string())] + [(c, pa.float32()) for c in INDICATOR_COLS]
+)
+
+def resample_sql(src_file, label_sql):
+    """把日线聚合成周/月线的 DuckDB 查询 (first/last 跳过空值，sum 全空记 0，与 pandas agg 口径一致)，按 (code, date) 排序"""
+    def first(c): return f"arg_min({c}, day) FILTER (WHERE {c} IS NOT NULL) AS {c}"
+    def last(c): return f"arg_max({c}, day) FILTER (WHERE {c} IS NOT NULL) AS {c}"
+    def total(c): return f"CAST(COALESCE(SUM({c}), 0) AS FLOAT) AS {c}"
+    aggs = [
+        first('open'), last('close'), "MAX(high) AS high", "MIN(low) AS low",
+        total('volume'), total('amount'), "CAST(AVG(turn) AS FLOAT) AS turn",
+        last('peTTM'), last('pbMRQ'), last('mkt_cap'), last('adjustFactor'),
+        total('net_flow_amount'), total('main_net_flow'),
+    ]
+    sql = f"""
+        SELECT * FROM (
+            SELECT CAST(bar AS DATE) AS date, {', '.join(aggs)}, code
+            FROM (
+                SELECT *, {label_sql} AS bar
+                FROM (SELECT *, CAST(date AS DATE) AS day FROM read_parquet('{src_file}') WHERE date IS NOT NULL)
+            )
+            GROUP BY code, bar
+        ) WHERE close IS NOT NULL
+        ORDER BY code, date
+    """
+    return sql
+
+def write_bars(sql, out_file):
+    """流式写出周/月线：按股票边界攒够 HISTORY_BATCH_ROWS 行就算一次指标、写一个 row group，内存不随全市场行数增长"""
+    tmp_file = f"{out_file}.tmp"
+    writer = None
+    pending, rows = [], 0
+
+    def flush():
+        nonlocal writer
+        # 每只股票一张表，起始行号由各表行数累加得到
+        starts = np.cumsum([0] + [t.num_rows for t in pending[:-1]], dtype=np.int64)
+        tbl = calculate_indicators_grouped(pa.concat_tables(pending), starts).cast(BAR_SCHEMA)
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_file, BAR_SCHEMA, **writer_options(BAR_SCHEMA))
+        writer.write_table(tbl, row_group_size=ROW_GROUP_ROWS)
+        pending.clear()
 
-    # 7. 其他
     try:
-        df['cci'] = df.ta.cci(high='high', low='low', close='close', length=14)
-        df['atr'] = df.ta.atr(high='high', low='low', close='close', length=14)
-    except: pass
+        for _, tbl in iter_by_code(sql):
+            pending.append(tbl)
+            rows += tbl.num_rows
+            if rows >= HISTORY_BATCH_ROWS:
+                flush()
+                rows = 0
+        if pending: flush()
+    finally:
+        if writer is not None: writer.close()
+    # 全部写完才替换，聚合中途失败不会留下半截文件
+    if writer is not None: os.replace(tmp_file, out_file)
 
-    return df
+def float32_table(tbl):
+    """float64 列在 Arrow 里先转 float32，之后拼接、转 pandas 都只搬一半字节"""
+    schema = pa.schema([f.with_type(pa.float32()) if pa.types.is_float64(f.type) else f for f in tbl.schema])
+    return tbl.cast(schema)
 
-def process_resample(writer_w, writer_m, df_daily):
-    """流式生成周/月线"""
-    if df_daily.empty: return
+def to_frame(tbl):
+    """Arrow 表转 DataFrame (date32/时间戳统一为 datetime64[ns]，float64 转 float32)，None 转为空表"""
+    if tbl is None: return pd.DataFrame()
+    return float32_table(tbl).to_pandas(date_as_object=False, coerce_temporal_nanoseconds=True)
 
-    agg_rules = {
-        'open': 'first', 'close': 'last', 'high': 'max', 'low': 'min',
-        'volume': 'sum', 'amount': 'sum', 'turn': 'mean',
-        'peTTM': 'last', 'pbMRQ': 'last', 'mkt_cap': 'last', 'adjustFactor': 'last'
-    }
-    # 资金流累加
-    flow_cols = [c for c in df_daily.columns if 'flow' in c]
-    for c in flow_cols: agg_rules[c] = 'sum'
+def timestamp_dates(tbl):
+    """date 列统一成 timestamp[ns]：date32/时间戳直接转换，字符串 (老文件) 按 ISO 格式解析，无法解析的为空"""
+    i = tbl.schema.get_field_index('date')
+    if i < 0: return tbl
+    col = tbl.column(i)
+    if pa.types.is_date(col.type) or pa.types.is_timestamp(col.type):
+        col = col.cast(pa.timestamp('ns'))
+    else:
+        col = pa.array(to_dates(col.to_pandas()), type=pa.timestamp('ns'))
+    return tbl.set_column(i, 'date', col)
 
-    # 周线
+def concat_frame(tables):
+    """历史切片与今日 K 线在 Arrow 里拼接 (缺列补空) 后一次转成 DataFrame；
+    列类型对不上 (如老归档里的脏类型) 时退回逐表转换再 pd.concat"""
+    tables = [timestamp_dates(float32_table(t)) for t in tables]
+    if len(tables) == 1: return to_frame(tables[0])
     try:
-        df_w = df_daily.set_index('date').resample('W-FRI').agg(agg_rules).dropna(subset=['close']).reset_index()
-        if not df_w.empty:
-            df_w['code'] = df_daily['code'].iloc[0]
-            for w in [5, 10, 20]:
-                df_w[f'ma{w}'] = df_w['close'].rolling(w).mean()
-            
-            # 安全转换
-            float_cols = df_w.select_dtypes(include=['float64']).columns
-            for col in float_cols:
-                df_w[col] = pd.to_numeric(df_w[col], errors='coerce').astype('float32')
-            
-            table_w = pa.Table.from_pandas(df_w)
-            writer_w.write_table(table_w)
-    except: pass
+        return to_frame(pa.concat_tables(tables, promote_options='default'))
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pd.concat([to_frame(t) for t in tables], ignore_index=True)
 
-    # 月线
+def read_mapped(path, columns=None):
+    """内存映射读取单个 Parquet 文件 (少一次内核到用户态的拷贝)；工作进程已经并行，单文件不再开线程
+
+    columns 给定时只解码文件里实际存在的这些列。
+    """
+    with pa.memory_map(path, 'r') as src:
+        pf = pq.ParquetFile(src)
+        if columns is not None:
+            columns = [c for c in columns if c in pf.schema_arrow.names]
+        return pf.read(columns=columns, use_threads=False)
+
+def to_dates(s):
+    """日期列转 datetime64：已是时间类型 (date32 读入) 直接返回，字符串按 ISO 格式解析，不走格式推断"""
+    if s.dtype.kind == 'M': return s
+    return pd.to_datetime(s, format='ISO8601', errors='coerce', cache=True)
+
+def read_flow(flow_file):
+    """读取单只股票的资金流文件 (一只股票一个文件)，不经 pandas 直接取 numpy 数组
+
+    返回 (日期 datetime64[ns], {列名: float64 数组})，已去掉空日期、按日期去重 (保留最后一条) 并升序；没有数据返回 None。
+    """
+    if not flow_file: return None
+    # 只读日期与资金流列 (code 列每行都要转成 Python 字符串，用不上就不读)
     try:
-        df_m = df_daily.set_index('date').resample('ME').agg(agg_rules).dropna(subset=['close']).reset_index()
-        if not df_m.empty:
-            df_m['code'] = df_daily['code'].iloc[0]
-            for w in [5, 10, 20]:
-                df_m[f'ma{w}'] = df_m['close'].rolling(w).mean()
-            
-            # 安全转换
-            float_cols = df_m.select_dtypes(include=['float64']).columns
-            for col in float_cols:
-                df_m[col] = pd.to_numeric(df_m[col], errors='coerce').astype('float32')
-            
-            table_m = pa.Table.from_pandas(df_m)
-            writer_m.write_table(table_m)
-    except: pass
+        tbl = timestamp_dates(read_mapped(flow_file, ['date'] + FLOW_RAW_COLS))
+        if tbl.num_rows == 0 or 'date' not in tbl.column_names: return None
+        dates = tbl.column('date').to_numpy()
+        # 倒序后 np.unique 取每个日期首次出现的位置，即原顺序里的最后一条
+        idx = np.flatnonzero(~np.isnat(dates))[::-1]
+        _, first = np.unique(dates[idx], return_index=True)
+        keep = idx[first]
+        cols = {c: tbl.column(c).to_numpy().astype(np.float64)[keep] for c in FLOW_RAW_COLS if c in tbl.column_names}
+        return dates[keep], cols
+    except: return None
+
+def without_code(tbl):
+    """去掉 code 列：单只股票内 code 恒定，不必转成逐行的 Python 字符串，输出时按参数重建"""
+    return tbl.select([c for c in tbl.column_names if c != 'code'])
+
+def process_code(code, hist, kline_file, flow_file):
+    """单只股票：读取今日 K 线与资金流、合并历史、计算指标，返回按日线 schema 组装好的 Arrow 表 (无数据返回 None)"""
+    tables = [hist] if hist is not None else []
+    
+    # B. 读取今日
+    if kline_file:
+        # 只解码宽表要用的列 (code 列由参数给出，不用读)
+        try: tables.append(read_mapped(kline_file, ['date'] + FLOAT_COLS))
+        except: pass
+    tables = [without_code(t) for t in tables if t.num_rows]
+    if not tables: return None
+    flow = read_flow(flow_file)
+    
+    # 合并：历史在 SQL 里已按日期排好序，常见情况是今日数据全部晚于历史，直接拼接即可
+    df = concat_frame(tables)
+    dates = df['date'].to_numpy()
+    if not (dates[1:] > dates[:-1]).all() or np.isnat(dates[0]):
+        # 日期有重叠、乱序或缺失时才去重 (K 线每天全量下载，与历史重叠是常态)：
+        # 只对日期做稳定排序，重复日期相邻 (历史在前、今日在后)，每段保留最后一行 (即 keep='last')，
+        # 再按行号一次取出，整表只复制一次
+        order = np.argsort(dates, kind='stable')
+        d = dates[order]
+        keep = np.r_[d[1:] != d[:-1], True] & ~np.isnat(d)
+        df = df.take(order[keep])
+    
+    # 落盘就是 float32，指标也直接在 float32 上算 (内核里累加仍用 float64)；
+    # 读入时已是 float32，这里只兜底拼接后被提升成 float64 的列
+    float_cols = df.select_dtypes(include='float64').columns
+    df[float_cols] = df[float_cols].to_numpy(np.float32)  # 一次二维转换，不逐列生成 Series
+    
+    # D. 关联资金流：两边日期都有序且唯一，二分定位后按位置覆盖 (新值非空才覆盖，同 combine_first)
+    if flow is not None:
+        try:
+            flow_dates, flow_cols = flow
+            dates = df['date'].to_numpy()
+            pos = np.minimum(np.searchsorted(dates, flow_dates), len(dates) - 1)
+            matched = dates[pos] == flow_dates
+            for col, src in flow_cols.items():
+                hit = matched & ~np.isnan(src)
+                if col in df.columns:
+                    arr = df[col].to_numpy(np.float32, copy=True)
+                else:
+                    arr = np.full(len(df), np.nan, dtype=np.float32)
+                arr[pos[hit]] = src[hit]
+                df[col] = arr
+        except: pass
+
+    # E. 计算指标
+    df = calculate_indicators(df)
+    
+    # F. 按日线 Schema 直接用 numpy 数组组装 Arrow 表 (不改 DataFrame、不做类型推断)
+    return daily_table(df, code)
+
+def compact(tbl):
+    """把切片复制成独立的紧凑表再交给工作进程：pyarrow pickle 切片时会把整个批次的缓冲区一起序列化
+    (code 列不随任务传输，工作进程按参数重建)"""
+    if tbl is None: return None
+    tbl = without_code(tbl)
+    return pa.Table.from_arrays([pa.concat_arrays(c.chunks) for c in tbl.columns], schema=tbl.schema)
+
+def process_chunk(chunk):
+    """工作进程入口：依次处理一批股票，结果按原顺序返回"""
+    return [process_code(*args) for args in chunk]
+
+def daily_table(df, code):
+    """按 DAILY_SCHEMA 逐列构造 Arrow 表：code 列由单个值重复生成，缺列补空，数值列统一 float32，NaN 记为 null (同 from_pandas)"""
+    n = len(df)
+    arrays = [pa.Array.from_pandas(df['date'], type=pa.date32()), pa.repeat(pa.scalar(code, pa.string()), n)]
+    for col in FLOAT_COLS:
+        if col not in df.columns:
+            arrays.append(pa.nulls(n, pa.float32()))
+            continue
+        if df[col].dtype.kind == 'f':
+            values = df[col].to_numpy(np.float32)
+        else:
+            # 【关键修复】安全的类型转换：非浮点列用 to_numeric 强制转数字，无法转换的(如错误的日期对象)变NaN
+            values = pd.to_numeric(df[col], errors='coerce').to_numpy(np.float32)
+        arrays.append(pa.array(values, type=pa.float32(), from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=DAILY_SCHEMA)
+
+def writer_options(schema):
+    """ParquetWriter 参数：PARQUET_OPTIONS 加上排序声明 (所有输出都按 (code, date) 升序写出)，
+    浮点列用 BYTE_STREAM_SPLIT 把同一字节位拼在一起，zstd 压得更小、解码也更快"""
+    return dict(
+        PARQUET_OPTIONS,
+        sorting_columns=pq.SortingColumn.from_ordering(schema, [('code', 'ascending'), ('date', 'ascending')]),
+        column_encoding={f.name: 'BYTE_STREAM_SPLIT' for f in schema if pa.types.is_floating(f.type)},
+    )
+
+def write_pending(writer, pending, force=False):
+    """pending 里攒的表超过 ROW_GROUP_ROWS 行 (或 force) 时合并成一个 row group 写出"""
+    if not pending or (not force and sum(t.num_rows for t in pending) < ROW_GROUP_ROWS): return
+    writer.write_table(pa.concat_tables(pending), row_group_size=sum(t.num_rows for t in pending))
+    pending.clear()
 
 def main():
     print("🚀 开始 DuckDB 流式合并与计算 (安全转换版)...")
+    # 扫代码、周/月线聚合是纯 DuckDB 工作，用满所有核
+    con.execute(f"SET threads={os.cpu_count() or 1};")
     
-    all_codes, history_files, kline_files = get_all_codes()
+    all_codes, history_files, kline_map = get_all_codes()
     if not all_codes:
         print("❌ 没有找到任何股票代码")
         return
     print(f"✅ 总计需处理: {len(all_codes)} 只股票")
 
-    # 建立索引
-    kline_map = {os.path.basename(f).replace('.parquet', ''): f for f in kline_files}
-    flow_files = glob.glob(f"{FLOW_DIR}/**/*.parquet", recursive=True)
-    flow_map = {os.path.basename(f).replace('.parquet', ''): f for f in flow_files}
+    # 资金流同样是一只股票一个文件，直接按 code 索引，由工作进程各自读取
+    flow_map = walk_parquet(FLOW_DIR)
 
     # 注册历史视图
     has_history = False
     if history_files:
         try:
-            files_sql = str(history_files).replace('[', '').replace(']', '')
-            con.execute(f"CREATE OR REPLACE VIEW history_view AS SELECT * FROM read_parquet({files_sql})")
+            con.execute(f"""
+                CREATE OR REPLACE VIEW history_view AS
+                SELECT * EXCLUDE (filename), filename = '{CACHE_OUTPUT_FILE}' AS from_buffer
+                FROM {parquet_source(history_files, filename=True)}
+            """)
             has_history = True
         except: pass
 
     # 定义 Schema
     print("🔒 锁定数据 Schema...")
-    dummy_data = {
-        'date': ['2025-01-01'], 
-        'code': ['dummy'],      
-    }
-    float_cols_def = [
-        'open', 'close', 'high', 'low', 'volume', 'amount', 'turn', 'pctChg', 
-        'peTTM', 'pbMRQ', 'adjustFactor', 'mkt_cap', 
-        'net_flow_amount', 'main_net_flow', 'super_large_net_flow', 'large_net_flow', 'medium_small_net_flow',
-        'ma5', 'ma10', 'ma20', 'ma60', 'ma120', 'ma250',
-        'vol_ma5', 'vol_ma10', 'vol_ma20', 'vol_ma30',
-        'dif', 'dea', 'macd', 'k', 'd', 'j', 'rsi6', 'rsi12', 'rsi24',
-        'boll_lb', 'boll_up', 'cci', 'atr'
-    ]
-    
-    for c in float_cols_def:
-        dummy_data[c] = [0.0]
-        
-    df_schema_template = pd.DataFrame(dummy_data)
-    df_schema_template[float_cols_def] = df_schema_template[float_cols_def].astype('float32')
-    final_schema = pa.Table.from_pandas(df_schema_template).schema
     
     # 初始化 Writers
-    writer_buffer = pq.ParquetWriter(CACHE_OUTPUT_FILE, final_schema, compression='zstd')
+    # buffer 本身也是历史输入之一，先写临时文件，全部读完后再替换，避免一打开就把历史截断
+    buffer_tmp = f"{CACHE_OUTPUT_FILE}.tmp"
+    writer_buffer = pq.ParquetWriter(buffer_tmp, BUFFER_SCHEMA, **writer_options(BUFFER_SCHEMA))
     
     current_year = datetime.datetime.now().year
     oss_file = f"{OUTPUT_DAILY}/stock_{current_year}.parquet"
-    writer_oss = pq.ParquetWriter(oss_file, final_schema, compression='zstd')
+    year_start = np.datetime64(f"{current_year}-01-01")
+    writer_oss = pq.ParquetWriter(oss_file, DAILY_SCHEMA, **writer_options(DAILY_SCHEMA))
     
-    weekly_buffer = []
-    monthly_buffer = []
 
     # 4. 🚀 循环处理
     print("🌊 开始流式处理...")
     
+    pending_buffer, pending_oss = [], []
+    
+    def flush(table):
+        """按提交顺序写出一只股票的结果 (写文件只在主进程进行)"""
+        if table is None: return
+        # 写入 Buffer (只保留行情与资金流列)
+        pending_buffer.append(table.select(BUFFER_SCHEMA.names))
+        write_pending(writer_buffer, pending_buffer)
+
+        # 写入 OSS (Current Year)：日期已升序，二分找到当年起点后零拷贝切片
+        start = int(np.searchsorted(table.column('date').to_numpy(), year_start))
+        if start < table.num_rows:
+            pending_oss.append(table.slice(start))
+            write_pending(writer_oss, pending_oss)
+
+    # 逐股阶段 CPU 留给工作进程，DuckDB 只做顺序扫描
+    con.execute("SET threads=2;")
+
+    # 多进程计算，主进程按顺序读数据、写结果；在途任务数有上限，内存不会随股票数增长
+    # 用 spawn 启动，避免 fork 继承主进程里正在运行的 DuckDB 线程
+    pool = ProcessPoolExecutor(max_workers=MERGE_WORKERS, mp_context=multiprocessing.get_context("spawn")) if MERGE_WORKERS > 1 else None
+    window = deque()
+    chunk = []
+    
+    # 历史只扫描一次：all_codes 与扫描结果都按 code 有序，按顺序对齐即可
+    history_of = code_cursor(scan_sorted('history_view') if has_history else iter(()), "历史数据")
+    
     for code in tqdm(all_codes):
-        # A. 读取历史
-        df_hist = pd.DataFrame()
-        if has_history:
-            try:
-                df_hist = con.execute(f"SELECT * FROM history_view WHERE code='{code}'").fetchdf()
-            except: pass
-        
-        # B. 读取今日
-        df_new = pd.DataFrame()
-        if code in kline_map:
-            try: df_new = pd.read_parquet(kline_map[code])
-            except: pass
-            
-        if df_hist.empty and df_new.empty: continue
+        # A. 取出历史 (顺序扫描里的 Arrow 切片)
+        hist = history_of(code)
             
-        # 统一日期 (转换为 datetime 对象)
-        if not df_hist.empty: 
-            df_hist['date'] = pd.to_datetime(df_hist['date'], errors='coerce')
-        if not df_new.empty: 
-            df_new['date'] = pd.to_datetime(df_new['date'], errors='coerce')
-        
-        # 合并
-        df = pd.concat([df_hist, df_new])
-        df.dropna(subset=['date'], inplace=True)
-        df.drop_duplicates(subset=['code', 'date'], keep='last', inplace=True)
-        df.sort_values('date', inplace=True)
-        
-        # D. 关联资金流
-        if code in flow_map and os.path.exists(flow_map[code]):
-            try:
-                df_flow = pd.read_parquet(flow_map[code])
-                df_flow['date'] = pd.to_datetime(df_flow['date'], errors='coerce')
-                
-                # Merge
-                df = pd.merge(df, df_flow, on=['date', 'code'], how='left', suffixes=('', '_new'))
-                
-                # Update cols
-                flow_raw_cols = ['net_flow_amount', 'main_net_flow', 'super_large_net_flow', 'large_net_flow', 'medium_small_net_flow']
-                for col in flow_raw_cols:
-                    if f"{col}_new" in df.columns:
-                        df[col] = df[f"{col}_new"].combine_first(df[col])
-                        df.drop(columns=[f"{col}_new"], inplace=True)
-            except: pass
-
-        # E. 计算指标
-        df = calculate_indicators(df)
-        
-        # F. 生成周/月线
-        process_resample(None, None, df)
-        
-        # Buffer 收集逻辑 (简化版复制)
-        agg_rules = {
-            'open': 'first', 'close': 'last', 'high': 'max', 'low': 'min',
-            'volume': 'sum', 'amount': 'sum', 'turn': 'mean',
-            'peTTM': 'last', 'pbMRQ': 'last', 'mkt_cap': 'last', 'adjustFactor': 'last'
-        }
-        for c in ['net_flow_amount', 'main_net_flow']: 
-            if c in df.columns: agg_rules[c] = 'sum'
-            
-        try:
-            w_df = df.set_index('date').resample('W-FRI').agg(agg_rules).dropna(subset=['close']).reset_index()
-            w_df['code'] = code
-            weekly_buffer.append(w_df)
-        except: pass
-        
-        try:
-            m_df = df.set_index('date').resample('ME').agg(agg_rules).dropna(subset=['close']).reset_index()
-            m_df['code'] = code
-            monthly_buffer.append(m_df)
-        except: pass
+        # B~F. 读取今日与资金流、合并、计算指标 (在工作进程中完成)
+        args = (code, hist, kline_map.get(code), flow_map.get(code))
+        if pool is None:
+            flush(process_code(*args))
+            continue
+        chunk.append((code, compact(hist), *args[2:]))
+        if len(chunk) >= MERGE_CHUNK:
+            window.append(pool.submit(process_chunk, chunk))
+            chunk = []
+            if len(window) >= MERGE_WORKERS * 2:
+                for table in window.popleft().result(): flush(table)
 
-        # G. 写入 Parquet
-        # 补齐 Schema
-        for col in final_schema.names:
-            if col not in df.columns:
-                df[col] = np.nan
-        
-        # 按照 Schema 顺序重排
-        df = df[final_schema.names]
-        
-        # 【关键修复】安全的类型转换
-        # 使用 to_numeric 强制转数字，无法转换的(如错误的日期对象)变NaN
-        for col in float_cols_def:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce').astype('float32')
-        
-        # 日期转 String
-        df['date'] = df['date'].dt.strftime('%Y-%m-%d')
-        
-        # 写入 Buffer
-        table = pa.Table.from_pandas(df, schema=final_schema)
-        writer_buffer.write_table(table)
-        
-        # 写入 OSS (Current Year)
-        df_curr = df[df['date'] >= f"{current_year}-01-01"]
-        if not df_curr.empty:
-            table_curr = pa.Table.from_pandas(df_curr, schema=final_schema)
-            writer_oss.write_table(table_curr)
-            
-        del df, table
+    if chunk:
+        window.append(pool.submit(process_chunk, chunk))
+    while window:
+        for table in window.popleft().result(): flush(table)
+    if pool is not None:
+        pool.shutdown()
+    # 工作进程已退出，周/月线聚合可以用满所有核
+    con.execute(f"SET threads={os.cpu_count() or 1};")
+    write_pending(writer_buffer, pending_buffer, force=True)
+    write_pending(writer_oss, pending_oss, force=True)
 
     writer_buffer.close()
+    os.replace(buffer_tmp, CACHE_OUTPUT_FILE)
     writer_oss.close()
     print("✅ 日线写入完成")
 
     # 5. 保存周/月线
     print("📅 保存周/月线...")
-    if weekly_buffer:
-        df_w = pd.concat(weekly_buffer, ignore_index=True)
-        df_w = df_w.groupby('code', group_keys=False).apply(lambda x: calculate_indicators(x.sort_values('date')))
-        
-        # 同样使用安全转换
-        float_cols = df_w.select_dtypes(include=['float64', 'object']).columns
-        for col in float_cols:
-            if col in float_cols_def:
-                 df_w[col] = pd.to_numeric(df_w[col], errors='coerce').astype('float32')
-
-        df_w['date'] = df_w['date'].dt.strftime('%Y-%m-%d')
-        df_w.to_parquet(f"{OUTPUT_ENGINE}/stock_weekly.parquet", index=False, compression='zstd')
-        
-    if monthly_buffer:
-        df_m = pd.concat(monthly_buffer, ignore_index=True)
-        df_m = df_m.groupby('code', group_keys=False).apply(lambda x: calculate_indicators(x.sort_values('date')))
-        
-        float_cols = df_m.select_dtypes(include=['float64', 'object']).columns
-        for col in float_cols:
-            if col in float_cols_def:
-                 df_m[col] = pd.to_numeric(df_m[col], errors='coerce').astype('float32')
-
-        df_m['date'] = df_m['date'].dt.strftime('%Y-%m-%d')
-        df_m.to_parquet(f"{OUTPUT_ENGINE}/stock_monthly.parquet", index=False, compression='zstd')
+    for label_sql, out_name in [(WEEK_LABEL_SQL, 'stock_weekly'), (MONTH_LABEL_SQL, 'stock_monthly')]:
+        # 全程留在 Arrow：聚合结果已是 float32、日期已是 date32，指标直接追加列后写出
+        try:
+            write_bars(resample_sql(CACHE_OUTPUT_FILE, label_sql), f"{OUTPUT_ENGINE}/{out_name}.parquet")
+        except Exception as e:
+            print(f"⚠️ {out_name} 聚合失败: {e}")
 
     print("🎉 任务全部完成")
 
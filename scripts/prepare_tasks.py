@@ -1,9 +1,9 @@
 # scripts/prepare_tasks.py
 import baostock as bs
-import json
-import random
+import orjson
 import os
 import sys
+import time
 from datetime import datetime, timedelta
 import pandas as pd
 
@@ -23,31 +23,57 @@ TEST_RANGE = (1000, 1100) # 取第1000到1100只，共100只
 TASK_COUNT = 20
 OUTPUT_DIR = "task_slices"
 META_DIR = "meta_data"
+
+# Baostock 原始股票列表的本地快照：TTL 内重跑 (同一天多次触发/本地调试) 直接复用，不登录、不查询
+# STOCK_LIST_TTL=0 可强制重新拉取。
+# 放在 meta_data 下的隐藏文件：cache_data/*.parquet 会被 merge_data 当作历史行情扫描，不能放那里；
+# upload-artifact 默认不打包隐藏文件，也不会混进 meta-data 产物
+STOCK_LIST_CACHE = os.path.join(META_DIR, ".stock_list_raw.parquet")
+STOCK_LIST_TTL = int(os.getenv("STOCK_LIST_TTL", 24 * 3600))
+
+# Baostock 查询失败时最多尝试的次数，两次之间按 1s、2s ... 指数退避
+RETRY_TIMES = 3
 # ============================================
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs(META_DIR, exist_ok=True)
 
+def query_with_retry(query, **kwargs):
+    """调用 Baostock 查询，error_code 非 0 时退避重试；重试用尽仍失败则返回最后一次结果，由调用方决定回退"""
+    for attempt in range(RETRY_TIMES):
+        rs = query(**kwargs)
+        if rs.error_code == '0' or attempt == RETRY_TIMES - 1:
+            return rs
+        print(f"⚠️ 查询失败 ({rs.error_msg})，{2 ** attempt}s 后重试...")
+        time.sleep(2 ** attempt)
+
 def get_valid_stock_list():
     """智能回溯获取有效的股票列表"""
-    for i in range(0, 10):
-        date_check = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        
-        # 1. 判断交易日
-        rs_date = bs.query_trade_dates(start_date=date_check, end_date=date_check)
-        if rs_date.error_code != '0' or not rs_date.next() or rs_date.get_row_data()[1] != '1':
-            continue 
-            
+    # 1. 一次查询最近 10 天的交易日历，不再逐日请求
+    today = datetime.now()
+    rs_date = query_with_retry(
+        bs.query_trade_dates, start_date=(today - timedelta(days=9)).strftime('%Y-%m-%d'), end_date=today.strftime('%Y-%m-%d')
+    )
+    trade_days = []
+    if rs_date.error_code == '0':
+        while rs_date.next():
+            day, is_trading = rs_date.get_row_data()[:2]
+            if is_trading == '1': trade_days.append(day)
+
+    # 从最近的交易日往前回溯
+    for date_check in sorted(trade_days, reverse=True):
         print(f"尝试获取 {date_check} 的股票列表...")
         
         # 2. 获取全列表
-        rs_stock = bs.query_all_stock(day=date_check)
+        rs_stock = query_with_retry(bs.query_all_stock, day=date_check)
         if rs_stock.error_code != '0':
             continue
             
+        # 方法先绑定到局部变量，逐行循环里不再重复查找属性
         data_list = []
-        while rs_stock.next():
-            data_list.append(rs_stock.get_row_data())
+        next_row, get_row, append = rs_stock.next, rs_stock.get_row_data, data_list.append
+        while next_row():
+            append(get_row())
             
         if len(data_list) > 0:
             print(f"✅ 成功获取 {date_check} 的数据，共 {len(data_list)} 条")
@@ -57,62 +83,76 @@ def get_valid_stock_list():
             
     raise Exception("❌ 致命错误：回溯 10 天仍未找到有效的股票列表数据！")
 
-def main():
-    mode_str = "⚡ 极速测试模式 (100只)" if IS_TEST_MODE else "🚀 全量生产模式 (全部)"
-    print(f"启动任务初始化: [{mode_str}]")
-    
+def load_stock_list():
+    """获取原始股票列表 (优先复用未过期的本地快照，只有未命中时才登录 Baostock)"""
+    if STOCK_LIST_TTL > 0 and os.path.exists(STOCK_LIST_CACHE) and time.time() - os.path.getmtime(STOCK_LIST_CACHE) < STOCK_LIST_TTL:
+        print(f"♻️ 复用本地股票列表快照: {STOCK_LIST_CACHE}")
+        return pd.read_parquet(STOCK_LIST_CACHE)
+
     lg = bs.login()
     if lg.error_code != '0':
         raise Exception(f"登录失败: {lg.error_msg}")
-
     try:
-        # 1. 获取全量原始列表
         stock_df = get_valid_stock_list()
-
-        # 2. 清洗过滤
-        stock_list = []
-        for _, row in stock_df.iterrows():
-            code, name = row['code'], row['code_name']
-            # 过滤逻辑：只保留A股(sh/sz/bj)，排除ST，排除退市
-            if code and code.startswith(('sh.', 'sz.', 'bj.')) and 'ST' not in name and '退' not in name:
-                stock_list.append({'code': code, 'name': name})
-
-        total_count = len(stock_list)
-        print(f"全市场清洗后有效股票: {total_count} 只")
-
-        # 3. 根据模式裁切
-        if IS_TEST_MODE:
-            start, end = TEST_RANGE
-            if total_count > start:
-                # 确保不超过边界
-                real_end = min(total_count, end)
-                stock_list = stock_list[start:real_end]
-                print(f"✂️ 已裁切: 仅保留索引 {start} 到 {real_end}，共 {len(stock_list)} 只")
-            else:
-                print("⚠️ 警告: 股票总数不足以进行测试切片，将使用全部股票。")
-        else:
-            print("✅ 使用全量股票列表，不进行裁切。")
-
-        # 4. 生成元数据 (stock_list.json)
-        meta_path = os.path.join(META_DIR, "stock_list.json")
-        with open(meta_path, "w", encoding="utf-8") as f:
-            json.dump(stock_list, f, ensure_ascii=False)
-        print(f"📄 前端元数据已生成: {meta_path}")
-
-        # 5. 任务分片
-        random.shuffle(stock_list) # 打乱顺序以实现负载均衡
-        chunk_size = (len(stock_list) + TASK_COUNT - 1) // TASK_COUNT
-
-        for i in range(TASK_COUNT):
-            subset = stock_list[i * chunk_size: (i + 1) * chunk_size]
-            path = os.path.join(OUTPUT_DIR, f"task_slice_{i}.json")
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(subset, f, ensure_ascii=False, indent=2)
-
-        print(f"📦 成功生成 {TASK_COUNT} 个任务分片 (平均每片 {chunk_size} 只)")
-
     finally:
         bs.logout()
 
+    try:
+        stock_df.to_parquet(STOCK_LIST_CACHE, index=False)
+    except Exception as e:
+        print(f"⚠️ 股票列表快照写入失败: {e}")
+    return stock_df
+
+def main():
+    mode_str = "⚡ 极速测试模式 (100只)" if IS_TEST_MODE else "🚀 全量生产模式 (全部)"
+    print(f"启动任务初始化: [{mode_str}]")
+    
+    # 1. 获取全量原始列表
+    stock_df = load_stock_list()
+
+    # 2. 清洗过滤
+    stock_list = []
+    for code, name in zip(stock_df['code'].to_numpy(), stock_df['code_name'].to_numpy()):
+        # 过滤逻辑：只保留A股(sh/sz/bj)，排除ST，排除退市
+        if code and code.startswith(('sh.', 'sz.', 'bj.')) and 'ST' not in name and '退' not in name:
+            stock_list.append({'code': code, 'name': name})
+
+    total_count = len(stock_list)
+    print(f"全市场清洗后有效股票: {total_count} 只")
+
+    # 3. 根据模式裁切
+    if IS_TEST_MODE:
+        start, end = TEST_RANGE
+        if total_count > start:
+            # 确保不超过边界
+            real_end = min(total_count, end)
+            stock_list = stock_list[start:real_end]
+            print(f"✂️ 已裁切: 仅保留索引 {start} 到 {real_end}，共 {len(stock_list)} 只")
+        else:
+            print("⚠️ 警告: 股票总数不足以进行测试切片，将使用全部股票。")
+    else:
+        print("✅ 使用全量股票列表，不进行裁切。")
+
+    # 4. 生成元数据 (stock_list.json)
+    meta_path = os.path.join(META_DIR, "stock_list.json")
+    with open(meta_path, "wb") as f:
+        f.write(orjson.dumps(stock_list))
+    print(f"📄 前端元数据已生成: {meta_path}")
+
+    # 5. 任务分片
+    # 按代码排序后跨步分配 (第 i 片取第 i, i+20, i+40... 只)：各交易所/板块均匀摊到每片，
+    # 片间数量最多差 1；不再随机打乱，同一份列表每次生成的分片完全相同
+    stock_list.sort(key=lambda s: s['code'])
+    chunk_size = (len(stock_list) + TASK_COUNT - 1) // TASK_COUNT
+
+    for i in range(TASK_COUNT):
+        subset = stock_list[i::TASK_COUNT]
+        path = os.path.join(OUTPUT_DIR, f"task_slice_{i}.json")
+        # 紧凑 UTF-8 输出 (orjson 不转义中文，也不缩进)，下载任务照常 json.load
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(subset))
+
+    print(f"📦 成功生成 {TASK_COUNT} 个任务分片 (平均每片 {chunk_size} 只)")
+
 if __name__ == "__main__":
     main()